@@ -48,6 +48,9 @@ def create_app():
         # Настройки префетчинга (сколько задач брать за раз)
         worker_prefetch_multiplier=1,
         
+        # Автоскейлер по глубине очереди (работает при запуске воркера с --autoscale)
+        worker_autoscaler='app.backpressure:QueueDepthAutoscaler',
+        
         # Периодические задачи
         beat_schedule={
             'cleanup-stale-locks': {
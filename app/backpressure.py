@@ -0,0 +1,153 @@
+import os
+import math
+import time
+import logging
+
+from celery.worker.autoscale import Autoscaler
+from celery.worker import state
+
+from app.outbox import enqueue_message
+
+logger = logging.getLogger(__name__)
+
+# Очередь Celery по умолчанию (в брокере Redis это список с тем же именем)
+DEFAULT_QUEUE = 'celery'
+
+# Пороги перехода в деградированные режимы
+DEGRADED_DEPTH = int(os.environ.get('BACKPRESSURE_DEGRADED_DEPTH', 20))
+DEGRADED_AGE = float(os.environ.get('BACKPRESSURE_DEGRADED_AGE', 15))
+OVERLOADED_DEPTH = int(os.environ.get('BACKPRESSURE_OVERLOADED_DEPTH', 60))
+OVERLOADED_AGE = float(os.environ.get('BACKPRESSURE_OVERLOADED_AGE', 30))
+
+# Сколько задач в очереди на один процесс считаем нормой
+TASKS_PER_WORKER = int(os.environ.get('BACKPRESSURE_TASKS_PER_WORKER', 5))
+MIN_WORKERS = int(os.environ.get('BACKPRESSURE_MIN_WORKERS', 1))
+MAX_WORKERS = int(os.environ.get('BACKPRESSURE_MAX_WORKERS', 10))
+
+# Записи о задачах старше этого считаем потерянными (задача истекает раньше)
+ENQUEUED_TTL = 300
+
+# Ответ, который получает клиент, если бот не успевает ответить вовремя
+HOLDING_MESSAGE = "Спасибо за сообщение! Мы ответим вам в ближайшее время."
+# Не чаще одного такого ответа в чат за это время (сек)
+HOLDING_MESSAGE_INTERVAL = 120
+
+MODE_NORMAL = 'normal'
+MODE_DEGRADED = 'degraded'
+MODE_OVERLOADED = 'overloaded'
+
+# Параметры постановки задачи в каждом режиме: задержка склейки сообщений.
+# Срок жизни задачи в очереди не задается здесь, он равен сроку ответа (app.deadline)
+MODE_SETTINGS = {
+    MODE_NORMAL: {'countdown': 0},
+    MODE_DEGRADED: {'countdown': 10},
+    MODE_OVERLOADED: {'countdown': 20},
+}
+
+
+def _enqueued_key(queue):
+    return f"backpressure:enqueued:{queue}"
+
+
+def mark_enqueued(redis_client, task_id, countdown=0, queue=DEFAULT_QUEUE):
+    """Запоминает, с какого момента задача готова к выполнению"""
+    redis_client.zadd(_enqueued_key(queue), {task_id: time.time() + countdown})
+
+
+def mark_dequeued(redis_client, task_id, queue=DEFAULT_QUEUE):
+    """Задача начала выполняться, была отменена или истекла"""
+    redis_client.zrem(_enqueued_key(queue), task_id)
+
+
+def queue_stats(redis_client, queue=DEFAULT_QUEUE):
+    """Глубина очереди и возраст самой старой ожидающей задачи (сек)"""
+    key = _enqueued_key(queue)
+    now = time.time()
+    with redis_client.pipeline() as pipe:
+        pipe.zremrangebyscore(key, '-inf', now - ENQUEUED_TTL)
+        pipe.llen(queue)
+        pipe.zcard(key)
+        pipe.zrange(key, 0, 0, withscores=True)
+        _, broker_depth, waiting, oldest = pipe.execute()
+    oldest_age = max(0.0, now - oldest[0][1]) if oldest else 0.0
+    return {
+        'queue': queue,
+        # Задачи с countdown воркер сразу забирает из списка брокера, поэтому учитываем и их
+        'depth': max(broker_depth, waiting),
+        'broker_depth': broker_depth,
+        'waiting': waiting,
+        'oldest_age': round(oldest_age, 1),
+    }
+
+
+def current_mode(stats):
+    """Режим работы по состоянию очереди"""
+    if stats['depth'] >= OVERLOADED_DEPTH or stats['oldest_age'] >= OVERLOADED_AGE:
+        return MODE_OVERLOADED
+    if stats['depth'] >= DEGRADED_DEPTH or stats['oldest_age'] >= DEGRADED_AGE:
+        return MODE_DEGRADED
+    return MODE_NORMAL
+
+
+def recommended_workers(stats, current=None):
+    """Рекомендуемое число процессов воркера по глубине и возрасту очереди"""
+    wanted = math.ceil(stats['depth'] / TASKS_PER_WORKER)
+    if stats['oldest_age'] >= DEGRADED_AGE:
+        # Очередь стареет: текущих процессов не хватает, добавляем еще один
+        wanted = max(wanted, (current or MIN_WORKERS) + 1)
+    return max(MIN_WORKERS, min(MAX_WORKERS, wanted))
+
+
+def worker_processes(celery_app, timeout=1.0):
+    """Сколько процессов сейчас у всех воркеров (по ответам inspect); None - неизвестно"""
+    try:
+        replies = celery_app.control.inspect(timeout=timeout).stats()
+    except Exception as e:
+        logger.warning(f"Не удалось опросить воркеры: {e}")
+        return None
+    if not replies:
+        return None
+    return sum(len(stats.get('pool', {}).get('processes', [])) for stats in replies.values())
+
+
+def send_holding_message(redis_client, tenant, chat_id):
+    """Отправляет клиенту сообщение-заглушку через outbox (не чаще HOLDING_MESSAGE_INTERVAL)"""
+    notified_key = f"backpressure:notified:{tenant.key}:{chat_id}"
+    if not redis_client.set(notified_key, 1, nx=True, ex=HOLDING_MESSAGE_INTERVAL):
+        return False
+    enqueue_message(redis_client, tenant, chat_id, tenant.holding_message or HOLDING_MESSAGE)
+    return True
+
+
+def record_dropped(redis_client, queue=DEFAULT_QUEUE):
+    redis_client.incr(f"backpressure:dropped:{queue}")
+
+
+def backpressure_report(redis_client, queue=DEFAULT_QUEUE, current=None):
+    """current - число процессов воркеров (worker_processes); без него рекомендации нет"""
+    stats = queue_stats(redis_client, queue)
+    return {
+        **stats,
+        'mode': current_mode(stats),
+        'worker_processes': current,
+        'recommended_workers': recommended_workers(stats, current) if current is not None else None,
+        'dropped': int(redis_client.get(f"backpressure:dropped:{queue}") or 0),
+    }
+
+
+class QueueDepthAutoscaler(Autoscaler):
+    """Автоскейлер Celery, учитывающий очередь в брокере, а не только задачи воркера
+
+    Подключается через worker_autoscaler и работает при запуске воркера с --autoscale.
+    """
+
+    @property
+    def qty(self):
+        reserved = len(state.reserved_requests)
+        try:
+            from app.tasks import redis_client
+            stats = queue_stats(redis_client)
+        except Exception as e:
+            logger.warning(f"Не удалось получить состояние очереди: {e}")
+            return reserved
+        return max(reserved, recommended_workers(stats, self.processes))
@@ -0,0 +1,193 @@
+import uuid
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Время жизни состояния чата (сек): ожидающие сообщения, id задачи и блокировка
+STATE_TTL = 150
+
+# Поля хэша состояния чата
+FIELD_MESSAGES = 'm'
+FIELD_TASK = 't'
+FIELD_LOCK = 'l'
+
+# Добавляет текст к ожидающим сообщениям, возвращает id текущей задачи
+APPEND_SCRIPT = """
+local current = redis.call('HGET', KEYS[1], 'm')
+if current then
+    redis.call('HSET', KEYS[1], 'm', current .. ' ' .. ARGV[1])
+else
+    redis.call('HSET', KEYS[1], 'm', ARGV[1])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return redis.call('HGET', KEYS[1], 't')
+"""
+
+# Забирает ожидающие сообщения; id задачи снимается, только если он наш
+FLUSH_SCRIPT = """
+local messages = redis.call('HGET', KEYS[1], 'm')
+redis.call('HDEL', KEYS[1], 'm')
+if redis.call('HGET', KEYS[1], 't') == ARGV[1] then
+    redis.call('HDEL', KEYS[1], 't')
+end
+return messages
+"""
+
+# Переназначает чат новой задаче, только если он все еще за старой.
+# ARGV[1] - старый id ('' - свой id уже снят при склейке, тогда чат свободен, если t нет),
+# ARGV[2] - новый id ('' - чат передается менеджеру), ARGV[3] - возвращаемый текст.
+# Текст ставится перед новыми сообщениями: если чат уже у другой задачи, ответит она
+REQUEUE_SCRIPT = """
+local current = redis.call('HGET', KEYS[1], 't')
+local owned
+if ARGV[1] ~= '' then
+    owned = current == ARGV[1]
+else
+    owned = not current
+end
+if ARGV[3] ~= '' and (not owned or ARGV[2] ~= '') then
+    local messages = redis.call('HGET', KEYS[1], 'm')
+    if messages then
+        redis.call('HSET', KEYS[1], 'm', ARGV[3] .. ' ' .. messages)
+    else
+        redis.call('HSET', KEYS[1], 'm', ARGV[3])
+    end
+    redis.call('EXPIRE', KEYS[1], ARGV[4])
+end
+if not owned then
+    return 0
+end
+if ARGV[2] ~= '' then
+    redis.call('HSET', KEYS[1], 't', ARGV[2])
+else
+    redis.call('HDEL', KEYS[1], 't')
+end
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return 1
+"""
+
+# Блокировка чата: поле l = "владелец|срок". Истекшую блокировку можно перехватить
+LOCK_SCRIPT = """
+local now = tonumber(redis.call('TIME')[1])
+local lock = redis.call('HGET', KEYS[1], 'l')
+if lock then
+    local expires_at = tonumber(string.match(lock, '|(%d+)$'))
+    if expires_at and expires_at > now then
+        return 0
+    end
+end
+redis.call('HSET', KEYS[1], 'l', ARGV[1] .. '|' .. (now + tonumber(ARGV[2])))
+if redis.call('TTL', KEYS[1]) < tonumber(ARGV[2]) then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 1
+"""
+
+UNLOCK_SCRIPT = """
+local lock = redis.call('HGET', KEYS[1], 'l')
+if lock and string.sub(lock, 1, string.len(ARGV[1]) + 1) == ARGV[1] .. '|' then
+    redis.call('HDEL', KEYS[1], 'l')
+    return 1
+end
+return 0
+"""
+
+
+class ChatState:
+    """Состояние чата в одном маленьком хэше Redis: u:{бот}:{чат}
+
+    m - ожидающие склейки сообщения, t - id задачи, l - владелец блокировки.
+    Все изменения выполняются Lua-скриптами за один запрос к Redis.
+    """
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self._append = redis_client.register_script(APPEND_SCRIPT)
+        self._flush = redis_client.register_script(FLUSH_SCRIPT)
+        self._requeue = redis_client.register_script(REQUEUE_SCRIPT)
+        self._lock = redis_client.register_script(LOCK_SCRIPT)
+        self._unlock = redis_client.register_script(UNLOCK_SCRIPT)
+
+    def key(self, tenant, chat_id):
+        return f"u:{tenant.tag}:{chat_id}"
+
+    def append_message(self, tenant, chat_id, text):
+        """Добавляет сообщение и возвращает id активной задачи (или None)"""
+        return self._append(keys=[self.key(tenant, chat_id)], args=[text, STATE_TTL])
+
+    def set_task(self, tenant, chat_id, task_id):
+        key = self.key(tenant, chat_id)
+        with self.redis_client.pipeline() as pipe:
+            pipe.hset(key, FIELD_TASK, task_id)
+            pipe.expire(key, STATE_TTL)
+            pipe.execute()
+
+    def flush_messages(self, tenant, chat_id, task_id):
+        """Забирает склеенный текст ожидающих сообщений"""
+        return self._flush(keys=[self.key(tenant, chat_id)], args=[task_id]) or ""
+
+    def claim_requeue(self, tenant, chat_id, old_task_id, new_task_id, text=""):
+        """Атомарно передает чат от old_task_id новой задаче; False - чат уже у другой задачи"""
+        return bool(self._requeue(
+            keys=[self.key(tenant, chat_id)],
+            args=[old_task_id or "", new_task_id or "", text or "", STATE_TTL],
+        ))
+
+    def acquire_lock(self, tenant, chat_id, owner, ttl=10):
+        return bool(self._lock(keys=[self.key(tenant, chat_id)], args=[owner, ttl]))
+
+    def release_lock(self, tenant, chat_id, owner):
+        return bool(self._unlock(keys=[self.key(tenant, chat_id)], args=[owner]))
+
+
+def memory_report(redis_client, tenant, chats, sample=200, text="Здравствуйте, сколько стоит доставка?"):
+    """Сравнивает память старой (отдельные ключи) и новой (хэш) схем на chats чатах
+
+    Записывает sample временных чатов в обеих схемах, измеряет MEMORY USAGE
+    и экстраполирует на chats. Временные ключи удаляются.
+    """
+    state = ChatState(redis_client)
+    run_id = uuid.uuid4().hex[:6]
+    sample = max(1, min(sample, chats))
+    old_prefix = f"user_{tenant.key}_"
+    old_keys, new_keys = [], []
+
+    try:
+        with redis_client.pipeline() as pipe:
+            for i in range(sample):
+                chat_id = f"7700{run_id}{i:06d}"
+                # Старая схема: список сообщений, id задачи и отдельный ключ блокировки
+                pipe.rpush(f"{old_prefix}{chat_id}_messages", text)
+                pipe.expire(f"{old_prefix}{chat_id}_messages", 90)
+                pipe.setex(f"{old_prefix}{chat_id}_task_id", 150, str(uuid.uuid4()))
+                pipe.set(f"lock:{chat_id}", "locked", ex=10)
+                old_keys += [f"{old_prefix}{chat_id}_messages", f"{old_prefix}{chat_id}_task_id", f"lock:{chat_id}"]
+            pipe.execute()
+
+        for i in range(sample):
+            chat_id = f"7700{run_id}{i:06d}"
+            state.append_message(tenant, chat_id, text)
+            state.set_task(tenant, chat_id, str(uuid.uuid4()))
+            state.acquire_lock(tenant, chat_id, "report")
+            new_keys.append(state.key(tenant, chat_id))
+
+        def _usage(keys):
+            with redis_client.pipeline() as pipe:
+                for key in keys:
+                    pipe.memory_usage(key, samples=0)
+                return sum(usage or 0 for usage in pipe.execute())
+
+        old_bytes = _usage(old_keys) / sample * chats
+        new_bytes = _usage(new_keys) / sample * chats
+    finally:
+        for keys in (old_keys, new_keys):
+            if keys:
+                redis_client.delete(*keys)
+
+    return {
+        "chats": chats,
+        "sample": sample,
+        "old_layout": {"keys": 3 * chats, "bytes": int(old_bytes)},
+        "new_layout": {"keys": chats, "bytes": int(new_bytes)},
+        "saved_percent": round(100 * (1 - new_bytes / old_bytes), 1) if old_bytes else 0.0,
+    }
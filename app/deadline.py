@@ -0,0 +1,68 @@
+import os
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд после постановки в очередь клиент еще ждет ответа
+MESSAGE_DEADLINE = float(os.environ.get('MESSAGE_DEADLINE', 60))
+
+DEADLINE_MISSES_KEY = "deadline:misses"
+
+
+class DeadlineExceeded(Exception):
+    """Срок ответа на сообщение истек на этапе stage
+
+    message_posted - текст клиента уже добавлен в тред ассистента, повторно его не отправляем
+    """
+
+    def __init__(self, stage, message_posted=False):
+        super().__init__(f"deadline exceeded at {stage}")
+        self.stage = stage
+        self.message_posted = message_posted
+
+
+class Deadline:
+    """Крайний срок ответа на сообщение (unix-время), передается через весь конвейер"""
+
+    def __init__(self, at=None):
+        # at=None означает "без ограничения" (служебные сообщения, старые задачи)
+        self.at = float(at) if at is not None else None
+
+    @classmethod
+    def after(cls, seconds):
+        return cls(time.time() + seconds)
+
+    @classmethod
+    def from_message(cls, message):
+        return cls(message.get('deadline'))
+
+    def remaining(self):
+        if self.at is None:
+            return float('inf')
+        return self.at - time.time()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def timeout(self, default):
+        """Тайм-аут для внешнего вызова: не больше оставшегося времени"""
+        return max(0.1, min(default, self.remaining()))
+
+    def check(self, stage, needed=0):
+        """Бросает DeadlineExceeded, если на этап stage осталось меньше needed секунд"""
+        if self.remaining() < needed:
+            raise DeadlineExceeded(stage)
+
+
+def record_miss(redis_client, stage):
+    """Учитывает пропущенный срок по этапу конвейера"""
+    logger.warning(f"---Срок ответа истек на этапе {stage}---")
+    try:
+        redis_client.hincrby(DEADLINE_MISSES_KEY, stage, 1)
+    except Exception as e:
+        logger.error(f"---Не удалось записать пропуск срока: {e}---")
+
+
+def deadline_misses(redis_client):
+    return {stage: int(count) for stage, count in redis_client.hgetall(DEADLINE_MISSES_KEY).items()}
@@ -0,0 +1,273 @@
+import os
+import time
+import uuid
+import zlib
+import random
+import logging
+import threading
+
+import redis
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+WAZZUP_MESSAGE_URL = "https://api.wazzup24.com/v3/message"
+
+# Исходящие сообщения разбиты на разделы по chatId: outbox:messages:{n}.
+# Число разделов нельзя менять, пока в outbox есть недоставленные сообщения
+OUTBOX_STREAM = "outbox:messages"
+OUTBOX_PARTITIONS = int(os.environ.get('OUTBOX_PARTITIONS', 16))
+OUTBOX_DEAD_STREAM = "outbox:dead"
+# Аренда раздела одним потоком отправителя (мс); продлевается, пока поток жив
+LEASE_TTL_MS = 30000
+# Сколько помнить уже отправленные ключи идемпотентности (сек)
+SENT_KEY_TTL = 24 * 3600
+# Эти ответы Wazzup временные, остальные 4xx повторять бессмысленно
+RETRYABLE_STATUSES = (408, 429)
+
+# Продлевает аренду, только если она все еще наша
+RENEW_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class PermanentSendError(Exception):
+    """Wazzup отклонил сообщение (неверный ключ, чат и т.п.), повтор не поможет"""
+
+
+def outbox_partition(chat_id):
+    return zlib.crc32(f"{chat_id}".encode()) % OUTBOX_PARTITIONS
+
+
+def outbox_stream(partition):
+    return f"{OUTBOX_STREAM}:{partition}"
+
+
+def _lease_key(partition):
+    return f"outbox:lease:{partition}"
+
+
+def enqueue_message(redis_client, tenant, chat_id, text, chat_type='whatsapp'):
+    """Записывает ответ в outbox. Возвращает ключ идемпотентности сообщения"""
+    idempotency_key = str(uuid.uuid4())
+    redis_client.xadd(outbox_stream(outbox_partition(chat_id)), {
+        'idempotency_key': idempotency_key,
+        'channel_id': tenant.channel_id,
+        'chat_id': f"{chat_id}",
+        'chat_type': chat_type,
+        'text': f"{text}",
+    })
+    return idempotency_key
+
+
+def redrive_dead(redis_client, count=None):
+    """Возвращает сообщения из dead-letter в outbox (после исправления причины)
+
+    Сообщение встает в конец раздела своего чата, то есть после ответов,
+    поставленных в очередь позже него. Возвращает число перенесенных сообщений.
+    """
+    moved = 0
+    while count is None or moved < count:
+        batch = 100 if count is None else min(100, count - moved)
+        entries = redis_client.xrange(OUTBOX_DEAD_STREAM, '-', '+', count=batch)
+        if not entries:
+            break
+        for message_id, fields in entries:
+            with redis_client.pipeline() as pipe:
+                pipe.xadd(outbox_stream(outbox_partition(fields.get('chat_id', ''))), fields)
+                pipe.xdel(OUTBOX_DEAD_STREAM, message_id)
+                pipe.execute()
+            moved += 1
+    return moved
+
+
+class OutboxSender:
+    """Пул отправителей: читает outbox и доставляет сообщения в Wazzup
+
+    Порядок сообщений чата сохраняется во всех процессах-отправителях: все
+    сообщения чата лежат в одном разделе, а раздел в каждый момент арендует
+    ровно один поток (outbox:lease:{n}) и отправляет его строго с головы.
+    Разные разделы отправляются параллельно; цена - сообщение, которое не
+    удается отправить, задерживает остальные чаты своего раздела.
+    """
+
+    def __init__(self, redis_client, tenant_registry, workers=4, alert_after=5,
+                 backoff_base=1.0, backoff_max=300.0, consumer_name=None):
+        self.redis_client = redis_client
+        self.tenant_registry = tenant_registry
+        self.workers = workers
+        # После стольких неудачных попыток подряд ошибки пишутся как ERROR
+        self.alert_after = alert_after
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.consumer_name = consumer_name or f"sender-{uuid.uuid4().hex[:8]}"
+        self._stop = threading.Event()
+        self._renew_lease = redis_client.register_script(RENEW_LEASE_SCRIPT)
+        self._release_lease = redis_client.register_script(RELEASE_LEASE_SCRIPT)
+
+        # Общий пул HTTP-соединений для всех потоков
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('https://', adapter)
+
+    def _acquire_partition(self, owner):
+        """Арендует любой непустой свободный раздел; None - работы нет"""
+        partitions = list(range(OUTBOX_PARTITIONS))
+        random.shuffle(partitions)
+        with self.redis_client.pipeline(transaction=False) as pipe:
+            for partition in partitions:
+                pipe.xlen(outbox_stream(partition))
+            lengths = pipe.execute()
+        for partition, length in zip(partitions, lengths):
+            if length and self.redis_client.set(_lease_key(partition), owner, nx=True, px=LEASE_TTL_MS):
+                return partition
+        return None
+
+    def _renew(self, partition, owner):
+        return bool(self._renew_lease(keys=[_lease_key(partition)], args=[owner, LEASE_TTL_MS]))
+
+    def _release(self, partition, owner):
+        self._release_lease(keys=[_lease_key(partition)], args=[owner])
+
+    def _wait(self, seconds, partition, owner):
+        """Пауза между попытками с продлением аренды; False - аренда потеряна"""
+        end = time.monotonic() + seconds
+        while not self._stop.is_set():
+            if not self._renew(partition, owner):
+                return False
+            left = end - time.monotonic()
+            if left <= 0:
+                return True
+            self._stop.wait(min(left, LEASE_TTL_MS / 3000))
+        return False
+
+    def _send(self, fields):
+        tenant = self.tenant_registry.get(fields['channel_id'])
+        if tenant is None:
+            # Повтор не поможет, пока бота не вернут в реестр (затем redrive)
+            raise PermanentSendError(f"Неизвестный канал {fields['channel_id']}")
+        json_data = {
+            'channelId': fields['channel_id'],
+            'chatId': fields['chat_id'],
+            'chatType': fields.get('chat_type', 'whatsapp'),
+            'text': fields['text'],
+            # Wazzup не создаст дубль сообщения с тем же crmMessageId
+            'crmMessageId': fields['idempotency_key'],
+        }
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {tenant.wazzup_api_key}',
+        }
+        response = self.session.post(WAZZUP_MESSAGE_URL, headers=headers, json=json_data, timeout=10)
+        if 400 <= response.status_code < 500 and response.status_code not in RETRYABLE_STATUSES:
+            raise PermanentSendError(f"Wazzup ответил {response.status_code}: {response.text[:200]}")
+        if not response.ok:
+            raise requests.HTTPError(f"Wazzup ответил {response.status_code}", response=response)
+        return response
+
+    def _ack(self, stream, message_id):
+        """Удаляет доставленную запись: в разделе остаются только недоставленные ответы"""
+        self.redis_client.xdel(stream, message_id)
+
+    def _dead_letter(self, stream, message_id, fields):
+        """Переносит отклоненный ответ в dead-letter поток (без обрезки; вернуть - redrive_dead)"""
+        with self.redis_client.pipeline() as pipe:
+            pipe.xadd(OUTBOX_DEAD_STREAM, fields)
+            pipe.xdel(stream, message_id)
+            pipe.execute()
+
+    def _deliver(self, partition, owner, message_id, fields):
+        """Доставляет голову раздела. False - аренда потеряна, раздел надо отпустить"""
+        stream = outbox_stream(partition)
+        sent_key = f"outbox:sent:{fields['idempotency_key']}"
+        if self.redis_client.exists(sent_key):
+            # Уже отправлено, но не удалено (например, отправитель упал до XDEL)
+            self._ack(stream, message_id)
+            return True
+
+        # Временные ошибки (сеть, 5xx, 408/429) повторяются, пока сообщение не уйдет:
+        # в dead-letter попадает только то, что Wazzup отклонил окончательно
+        attempt = 0
+        while not self._stop.is_set():
+            try:
+                response = self._send(fields)
+                self.redis_client.set(sent_key, 1, ex=SENT_KEY_TTL)
+                self._ack(stream, message_id)
+                logger.info(f"***Outbox {message_id} -> {fields['chat_id']}: {response.status_code}***")
+                return True
+            except PermanentSendError as e:
+                logger.error(f"---Сообщение {message_id} отклонено: {e}, перенесено в {OUTBOX_DEAD_STREAM}---")
+                self._dead_letter(stream, message_id, fields)
+                return True
+            except Exception as e:
+                attempt += 1
+                delay = min(self.backoff_max, self.backoff_base * (2 ** min(attempt - 1, 16)))
+                if attempt >= self.alert_after:
+                    logger.error(f"---Не удается отправить {message_id} (попытка {attempt}): {e}, повтор через {delay:.0f} с---")
+                else:
+                    logger.warning(f"Ошибка отправки {message_id} (попытка {attempt}): {e}")
+                if not self._wait(delay, partition, owner):
+                    return False
+        return False
+
+    def _drain(self, partition, owner):
+        """Отправляет раздел с головы, пока он не опустеет или не потеряна аренда"""
+        stream = outbox_stream(partition)
+        while not self._stop.is_set():
+            if not self._renew(partition, owner):
+                logger.warning(f"Потеряна аренда раздела outbox {partition}")
+                return
+            entries = self.redis_client.xrange(stream, '-', '+', count=20)
+            if not entries:
+                return
+            for message_id, fields in entries:
+                if self._stop.is_set() or not self._deliver(partition, owner, message_id, fields):
+                    return
+
+    def _worker_loop(self, index):
+        owner = f"{self.consumer_name}:{index}"
+        while not self._stop.is_set():
+            partition = None
+            try:
+                partition = self._acquire_partition(owner)
+                if partition is None:
+                    self._stop.wait(0.5)
+                    continue
+                self._drain(partition, owner)
+            except redis.exceptions.ConnectionError as e:
+                logger.error(f"---Ошибка подключения Redis в outbox: {e}---")
+                self._stop.wait(1)
+            except Exception as e:
+                # Сообщение остается в разделе и будет отправлено повторно
+                logger.error(f"---Ошибка в отправителе {index}: {e}---")
+            finally:
+                if partition is not None:
+                    try:
+                        self._release(partition, owner)
+                    except redis.exceptions.RedisError:
+                        # Аренда истечет сама через LEASE_TTL_MS
+                        pass
+
+    def run(self):
+        threads = [
+            threading.Thread(target=self._worker_loop, args=(i,), daemon=True)
+            for i in range(self.workers)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def stop(self):
+        self._stop.set()
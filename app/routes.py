@@ -1,18 +1,36 @@
 from flask import Blueprint, request, jsonify, render_template
 from app.tasks import (
-    process_user_messages, 
+    schedule_chat,
+    queue_mode,
     get_conversation_history, 
     check_status_conversation, 
     message_to_manager, 
     redis_client,
-    clean_url,
+    probe_redis_client,
+    tenant_registry,
+    chat_state,
     SQLiteConnection,
+    SQLITE_DB_PATH,
+    HISTORY_UNAVAILABLE_KEY,
     extract_role_content,
     client
 )
 import os
 import re
+import hmac
+import time
+import sqlite3
+from functools import wraps
+from celery import current_app as current_celery_app
 from celery.result import AsyncResult
+from app.deadline import deadline_misses
+from app.backpressure import (
+    MODE_OVERLOADED,
+    mark_dequeued,
+    send_holding_message,
+    backpressure_report,
+    worker_processes,
+)
 import logging
 
 # Настройка логирования
@@ -37,12 +55,16 @@ bp = Blueprint('routes', __name__)
 def hello_history():
     """Маршрут для просмотра истории сообщений"""
     user_id = request.args.get('userid')
+    channel_id = request.args.get('channel')
     logger.info(f"-**Get history {user_id}***")
 
     if not user_id:
         return "Не указан ID пользователя", 400
+    tenant = tenant_registry.get(channel_id) if channel_id else tenant_registry.default()
+    if tenant is None:
+        return "Неизвестный канал", 404
     try:
-        thread_id = get_conversation_history(user_id)
+        thread_id = get_conversation_history(user_id, tenant=tenant)
         logger.info(f"-**Get {user_id} (->) {thread_id}***")
         messages = client.beta.threads.messages.list(thread_id=thread_id)
         data = extract_role_content(messages,True)
@@ -58,7 +80,6 @@ def webhook():
     """Webhook для обработки входящих сообщений"""
     try:
         data = request.get_json()
-        channel_id = os.getenv("channal_id")
         
         # Проверяем структуру данных
         if not data or 'messages' not in data:
@@ -78,15 +99,16 @@ def webhook():
             logger.info(f"3**In webhook data had authorName***")
             return jsonify({"status": "bot_message_ignored"}), 200
             
-        # Проверяем, что сообщение из нужного канала
-        if first_message.get('channelId') != channel_id:
+        # Проверяем, что сообщение из зарегистрированного канала
+        tenant = tenant_registry.get(first_message.get('channelId'))
+        if tenant is None:
             logger.info(f"4**Chanal id is not same***")
             return jsonify({"status": "wrong_channel"}), 200
             
         user_id = first_message.get('chatId')
         
         # Проверяем статус разговора
-        if not check_status_conversation(user_id):
+        if not check_status_conversation(user_id, tenant):
             logger.info(f"5**Users conversation status are closed***")
             return jsonify({"status": "conversation_closed"}), 200
             
@@ -103,45 +125,35 @@ def webhook():
             message_to_manager(first_message, False)
             return jsonify({"status": "instagram_link_forwarded"}), 200
             
-        # Формируем ключ для Redis
-        user_key = f"user_{clean_url(os.environ.get('bot_url'))}_{user_id}"
+        # Режим работы по состоянию очереди Celery
+        mode = queue_mode()
         
         try:
-            # Используем pipeline для группировки операций Redis
-            with redis_client.pipeline() as pipe:
-                # Добавляем сообщение в список и устанавливаем срок жизни
-                pipe.rpush(f"{user_key}_messages", message_text)
-                pipe.expire(f"{user_key}_messages", 90)
-                logger.info(f"8**Message text: {message_text}***")
-                # Получаем текущий task_id
-                pipe.get(f"{user_key}_task_id")
-                results = pipe.execute()
-                
-                current_task_id = results[2]  # Результат команды get
-                
-                # Если есть активная задача
-                if current_task_id:
-                    logger.info(f"***Current task: {current_task_id}***")
-                    # Устанавливаем новый срок жизни для task_id
-                    redis_client.expire(f"{user_key}_task_id", 90)
-                    
-                    # Отменяем текущую задачу, если она еще не завершена
-                    task = AsyncResult(current_task_id)
-                    if not task.ready():
-                        logger.info(f"***Task revoke: {current_task_id}***")
-                        task.revoke(terminate=True)
-                
-                # Создаем новую асинхронную задачу
-                new_task = process_user_messages.apply_async(
-                    args=[user_id, first_message],
-                    expires=35  # Задача истекает через 150 секунд
-                )
-                
-                # Устанавливаем новый task_id с TTL
-                logger.info(f"***New task: {new_task.id}***")
-                redis_client.setex(f"{user_key}_task_id", 150, new_task.id)
+            # Добавляем сообщение в состояние чата и получаем текущий task_id (один вызов скрипта)
+            logger.info(f"8**Message text: {message_text}***")
+            current_task_id = chat_state.append_message(tenant, user_id, message_text)
+            
+            # Если есть активная задача
+            if current_task_id:
+                logger.info(f"***Current task: {current_task_id}***")
                 
-                return jsonify({"status": "message_queued", "task_id": new_task.id}), 200
+                # Отменяем текущую задачу, если она еще не завершена
+                task = AsyncResult(current_task_id)
+                if not task.ready():
+                    logger.info(f"***Task revoke: {current_task_id}***")
+                    task.revoke(terminate=True)
+                    mark_dequeued(redis_client, current_task_id)
+            
+            # При перегрузке дольше склеиваем сообщения и сразу предупреждаем клиента
+            if mode == MODE_OVERLOADED:
+                logger.info(f"***Queue overloaded, holding message to {user_id}***")
+                send_holding_message(redis_client, tenant, user_id)
+            
+            # Создаем новую асинхронную задачу; крайний срок ответа идет через весь конвейер
+            new_task = schedule_chat(tenant, user_id, first_message, mode)
+            logger.info(f"***New task: {new_task.id} ({mode})***")
+            
+            return jsonify({"status": "message_queued", "task_id": new_task.id, "mode": mode}), 200
                 
         except Exception as e:
             # Логируем ошибку
@@ -160,79 +172,112 @@ def index():
     """Корневой маршрут"""
     return "Hello, World!"
 
-# Можно добавить маршрут для проверки состояния Redis
-@bp.route('/health')
-def health_check():
-    """Проверка состояния Redis и получение данных из SQLite"""
-    result = {
-        "status": "ok",
-        "redis": {},
-        "sqlite": {
-            "users": []
-        }
-    }
+# Результат последней проверки готовности (кэшируется, чтобы пробы балансировщика не нагружали Redis и SQLite)
+READINESS_TTL = 5
+_readiness_cache = {"checked_at": 0, "result": None}
+
+def _check_readiness():
+    """Проверяет Redis (PING) и SQLite (SELECT 1), каждую не дольше ~1 секунды"""
+    result = {"status": "ok", "redis": {}, "sqlite": {}}
 
-    # Проверка Redis
     try:
-        info = redis_client.info()
-        connected_clients = info.get('connected_clients', 0)
-        total_connections_received = info.get('total_connections_received', 0)
-        
-        result["redis"] = {
-            "connected": True,
-            "connected_clients": connected_clients,
-            "total_connections_received": total_connections_received
-        }
+        probe_redis_client.ping()
+        result["redis"] = {"connected": True}
     except Exception as e:
-        result["redis"] = {
-            "connected": False,
-            "error": str(e)
-        }
-    
-    # Получение данных из SQLite
+        result["redis"] = {"connected": False, "error": str(e)}
+
     try:
-        with SQLiteConnection() as cursor:
-            cursor.execute('SELECT user_id, history FROM conversation_history')
-            rows = cursor.fetchall()
-            
-            for row in rows:
-                user_id, thread_id = row
-                result["sqlite"]["users"].append({
-                    "user_id": user_id,
-                    "thread_id": thread_id
-                })
-            
-            result["sqlite"]["status"] = "ok"
-            result["sqlite"]["total_users"] = len(rows)
+        if not os.path.exists(SQLITE_DB_PATH):
+            # База создается при первом обращении, ее отсутствие - не ошибка
+            result["sqlite"] = {"status": "ok", "exists": False}
+        else:
+            # Только чтение: проба ничего не создает и не коммитит
+            conn = sqlite3.connect(f"file:{SQLITE_DB_PATH}?mode=ro", uri=True, timeout=1)
+            try:
+                conn.execute('SELECT 1').fetchone()
+            finally:
+                conn.close()
+            result["sqlite"] = {"status": "ok"}
     except Exception as e:
-        result["sqlite"] = {
-            "status": "error",
-            "error": str(e)
-        }
-    
-    # Определяем общий статус на основе обеих проверок
-    if result["redis"].get("connected", False) == False or result["sqlite"].get("status") == "error":
+        result["sqlite"] = {"status": "error", "error": str(e)}
+
+    if not result["redis"]["connected"] or result["sqlite"]["status"] == "error":
         result["status"] = "error"
+    return result
+
+@bp.route('/healthz')
+def healthz():
+    """Проверка живости процесса, не обращается к внешним сервисам"""
+    return jsonify({"status": "ok"})
+
+@bp.route('/readyz')
+@bp.route('/health')
+def readyz():
+    """Проверка готовности: Redis и SQLite, результат кэшируется на READINESS_TTL секунд"""
+    now = time.monotonic()
+    if _readiness_cache["result"] is None or now - _readiness_cache["checked_at"] > READINESS_TTL:
+        _readiness_cache["result"] = _check_readiness()
+        _readiness_cache["checked_at"] = now
+
+    result = _readiness_cache["result"]
+    if result["status"] == "error":
         return jsonify(result), 500
-    
     return jsonify(result)
-    """Проверка состояния Redis"""
+
+def admin_required(view):
+    """Доступ к админ-маршрутам только с ADMIN_TOKEN; без настроенного токена маршрутов нет"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        admin_token = os.environ.get('ADMIN_TOKEN')
+        if not admin_token:
+            return jsonify({"status": "not_found"}), 404
+        supplied = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(supplied.encode(), f"Bearer {admin_token}".encode()):
+            return jsonify({"status": "unauthorized"}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+@bp.route('/admin/backpressure')
+@admin_required
+def admin_backpressure():
+    """Состояние очереди, режим работы и рекомендуемое число воркеров"""
     try:
-        # Проверяем подключение к Redis
-        info = redis_client.info()
-        connected_clients = info.get('connected_clients', 0)
-        total_connections_received = info.get('total_connections_received', 0)
-        
         return jsonify({
             "status": "ok",
-            "redis": {
-                "connected": True,
-                "connected_clients": connected_clients,
-                "total_connections_received": total_connections_received
-            }
+            **backpressure_report(redis_client, current=worker_processes(current_celery_app)),
+            "deadline_misses": deadline_misses(redis_client),
+            "history_unavailable": int(redis_client.get(HISTORY_UNAVAILABLE_KEY) or 0),
         })
     except Exception as e:
-        return jsonify({
-            "status": "error",
-            "message": f"Redis error: {str(e)}"
-        }), 500
\ No newline at end of file
+        return jsonify({"status": "error", "error": str(e)}), 500
+
+@bp.route('/admin/users')
+@admin_required
+def admin_users():
+    """Постраничный список пользователей из SQLite (keyset-пагинация по user_id)"""
+    after = request.args.get('after', '')
+    try:
+        limit = min(max(int(request.args.get('limit', 100)), 1), 500)
+    except ValueError:
+        return jsonify({"status": "invalid_limit"}), 400
+
+    try:
+        with SQLiteConnection() as cursor:
+            cursor.execute(
+                'SELECT user_id, history FROM conversation_history WHERE user_id > ? ORDER BY user_id LIMIT ?',
+                (after, limit)
+            )
+            rows = cursor.fetchall()
+            # COUNT(*) по таблице с PRIMARY KEY обходит индекс, а не сами строки
+            cursor.execute('SELECT COUNT(*) FROM conversation_history')
+            total_users = cursor.fetchone()[0]
+    except Exception as e:
+        return jsonify({"status": "error", "error": str(e)}), 500
+
+    users = [{"user_id": row["user_id"], "thread_id": row["history"]} for row in rows]
+    return jsonify({
+        "status": "ok",
+        "users": users,
+        "total_users": total_users,
+        "next_after": users[-1]["user_id"] if len(users) == limit else None,
+    })
@@ -1,4 +1,5 @@
 from celery import shared_task
+from celery.signals import task_revoked
 import redis
 from openai import OpenAI
 import requests
@@ -12,6 +13,22 @@ from redis import ConnectionPool
 import logging
 import json
 import threading
+import uuid
+from datetime import datetime, timezone
+from app.tenants import TenantRegistry
+from app.outbox import enqueue_message
+from app.backpressure import (
+    MODE_SETTINGS,
+    MODE_NORMAL,
+    queue_stats,
+    current_mode,
+    mark_enqueued,
+    mark_dequeued,
+    record_dropped,
+    send_holding_message,
+)
+from app.deadline import Deadline, DeadlineExceeded, MESSAGE_DEADLINE, record_miss
+from app.chat_state import ChatState
 
 logger = logging.getLogger(__name__)
 url_database = "https://ailiner.kz/history"
@@ -74,11 +91,36 @@ class JSONStorage:
                     logger.error("Не удалось сохранить данные после нескольких попыток")
                     return False
 
+class HistoryUnavailable(Exception):
+    """База истории не отвечает, хотя срок ответа еще не истек"""
+
+# Счетчик обращений, не получивших историю из-за недоступности базы
+HISTORY_UNAVAILABLE_KEY = "history:unavailable"
+# Без срока ответа (веб-маршрут /history) делаем один короткий запрос: ждет человек
+HISTORY_WEB_TIMEOUT = 5
+
+def post_history(payload, deadline, attempts=3):
+    """POST в базу истории с повторами по тайм-ауту, пока хватает срока ответа"""
+    default_timeout = 10
+    if deadline.at is None:
+        attempts, default_timeout = 1, HISTORY_WEB_TIMEOUT
+    for attempt in range(attempts):
+        deadline.check('history')
+        try:
+            return requests.post(url_database, json=payload, timeout=deadline.timeout(default_timeout))
+        except (requests.Timeout, requests.ConnectionError) as e:
+            logger.warning(f"База истории недоступна ({attempt+1}/{attempts}): {e}")
+    # Срок мог истечь за время последней попытки - это обычный пропуск срока
+    deadline.check('history')
+    raise HistoryUnavailable(f"база истории не ответила за {attempts} попыток")
+
 # Теперь реализуем те же функции, что и раньше
-def get_conversation_history(user_id, history=False):
+def get_conversation_history(user_id, history=False, tenant=None, deadline=None):
     """Получает историю разговора пользователя"""
+    tenant = tenant or tenant_registry.default()
+    deadline = deadline or Deadline()
     try:
-        response = requests.post(url_database,json={"user_id":f"{user_id}_{os.environ.get('bot_url')}"})
+        response = post_history({"user_id":f"{user_id}_{tenant.bot_url}"}, deadline)
         data = response.json()
         thread_id = data.get("thread_id",None)
         logger.info(f"???Response  thread object -> {thread_id}")
@@ -94,21 +136,25 @@ def get_conversation_history(user_id, history=False):
         else:
             return thread_id
             
+    except (DeadlineExceeded, HistoryUnavailable):
+        # Не создаем новый тред из-за тайм-аута, иначе клиент потеряет историю
+        raise
     except Exception as e:
         logger.error(f"Ошибка при получении истории разговора: {e}", exc_info=True)
         return None
 
-def save_conversation_history(user_id, history):
+def save_conversation_history(user_id, history, tenant=None, deadline=None):
     """Сохраняет историю разговора пользователя"""
+    tenant = tenant or tenant_registry.default()
+    deadline = deadline or Deadline()
     try:
-        response = requests.post(url_database,json={"user_id":f"{user_id}_{os.environ.get('bot_url')}","thread_id":f"{history}"})
+        response = requests.post(url_database,json={"user_id":f"{user_id}_{tenant.bot_url}","thread_id":f"{history}"}, timeout=deadline.timeout(10))
         data = response.json()
         logger.info("conversation succesful written")
     except Exception as e:
         logger.error(f"Ошибка при сохранении истории разговора: {e}", exc_info=True)
 
 client = OpenAI(api_key=os.environ.get('OPENAI_KEY'))
-assistant = client.beta.assistants.retrieve(os.environ.get('ASSISTANT_KEY'))
 
 redis_url = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
 
@@ -133,9 +179,49 @@ redis_pool = ConnectionPool.from_url(
 # Создаем клиента Redis, использующего пул соединений
 redis_client = redis.Redis(connection_pool=redis_pool)
 
+# Отдельный маленький пул с короткими тайм-аутами для проверок готовности
+probe_redis_client = redis.Redis(connection_pool=ConnectionPool.from_url(
+    url=redis_url,
+    max_connections=2,
+    decode_responses=True,
+    **{**ssl_params, 'socket_connect_timeout': 1, 'socket_timeout': 1}
+))
+
 #redis_client = redis.from_url(os.environ.get('REDIS_URL'))
-def clean_url(url: str) -> str:
-    return re.sub(r'https://|\.herokuapp\.com/', '', url)
+
+# Состояние чатов: по одному хэшу на чат
+chat_state = ChatState(redis_client)
+
+# Реестр ботов: один web/worker обслуживает всех клиентов
+tenant_registry = TenantRegistry(redis_client)
+
+def resolve_tenant(message):
+    """Определяет бота по channelId сообщения"""
+    return tenant_registry.get(message.get('channelId')) or tenant_registry.default()
+
+# Задача не дольше task_time_limit, поэтому старые записи о слотах считаем зависшими
+TENANT_SLOT_TTL = 130
+
+def acquire_tenant_slot(tenant, task_id):
+    """Занимает слот бота в общем пуле воркеров (не больше max_concurrency задач на бота)"""
+    limit = tenant_registry.concurrency_limit(tenant)
+    if limit is None:
+        return True
+    key = f"tenant_slots:{tenant.key}"
+    now = time.time()
+    with redis_client.pipeline() as pipe:
+        pipe.zremrangebyscore(key, '-inf', now - TENANT_SLOT_TTL)
+        pipe.zadd(key, {task_id: now}, nx=True)
+        pipe.zrank(key, task_id)
+        pipe.expire(key, TENANT_SLOT_TTL)
+        rank = pipe.execute()[2]
+    if rank is not None and rank < limit:
+        return True
+    redis_client.zrem(key, task_id)
+    return False
+
+def release_tenant_slot(tenant, task_id):
+    redis_client.zrem(f"tenant_slots:{tenant.key}", task_id)
 
 # Вспомогательная функция для выполнения операций Redis с автоматической обработкой ошибок
 def redis_operation(operation_func, retry_count=3, retry_delay=1):
@@ -154,47 +240,188 @@ def redis_operation(operation_func, retry_count=3, retry_delay=1):
             print(f"Ошибка при работе с Redis: {e}")
             raise
 
-@shared_task
-def process_user_messages(user_id, data):
+@shared_task(bind=True, max_retries=30)
+def process_user_messages(self, user_id, data):
     """Обрабатывает сообщения пользователя из Redis и отправляет ответ"""
-    time.sleep(5)
-    prefix = f"user_{clean_url(os.environ.get('bot_url'))}_{user_id}"
-    
-    def _get_and_clear_messages():
-        # Получаем сообщения и сразу очищаем данные в Redis (используя pipeline для атомарности)
-        with redis_client.pipeline() as pipe:
-            pipe.lrange(f"{prefix}_messages", 0, -1)
-            pipe.delete(f"{prefix}_messages")
-            pipe.delete(f"{prefix}_task_id")
-            results = pipe.execute()
-            return results[0]  # Первый результат - это список сообщений
+    tenant = resolve_tenant(data)
+    deadline = Deadline.from_message(data)
+    if self.request.retries == 0:
+        redis_operation(lambda: mark_dequeued(redis_client, self.request.id))
+        time.sleep(min(5, max(0, deadline.remaining())))
+    # Срок ответа истек: не тратим воркер на GPT, а ставим чат заново или зовем менеджера
+    if deadline.expired():
+        record_miss(redis_client, 'dequeue')
+        requeue_or_escalate(tenant, user_id, data, task_id=self.request.id)
+        return
+    # Честное разделение пула: бот, занявший все свои слоты, уступает воркер другим
+    if not acquire_tenant_slot(tenant, self.request.id):
+        if self.request.retries >= self.max_retries:
+            logger.warning(f"---Слот для {tenant.key} так и не освободился, задача {self.request.id} снята---")
+            if requeue_or_escalate(tenant, user_id, data, task_id=self.request.id):
+                record_dropped(redis_client)
+            return
+        logger.info(f"***Нет свободного слота для {tenant.key}, задача отложена***")
+        raise self.retry(countdown=1)
     
+    combined_messages = ""
     try:
-        # Получаем и обрабатываем сообщения
-        messages = redis_operation(_get_and_clear_messages)
-        
-        # Объединяем сообщения в один текст (они уже декодированы благодаря decode_responses=True)
-        combined_messages = " ".join(messages)
+        # Забираем уже склеенные сообщения и снимаем свой task_id (атомарно, скриптом в Redis)
+        combined_messages = redis_operation(
+            lambda: chat_state.flush_messages(tenant, user_id, self.request.id)
+        )
         
         # Формируем общий ответ и обновляем данные для webhook
         data['text'] = combined_messages
         
-        # Отправляем ответ через webhook, если есть текст
-        if data['text'] and not data['text'].isspace():
+        # Отправляем ответ через webhook, если есть текст или сообщение уже ждет в треде
+        if (data['text'] and not data['text'].isspace()) or data.get('run_pending'):
             logger.info(f"*1*Joined webhook text: {data['text']} ***")
-            webhook(data)
+            webhook(data, tenant=tenant, deadline=deadline)
             
         print(f"Отправлен ответ пользователю {user_id}: текст длиной {len(combined_messages)} символов")
+    except DeadlineExceeded as e:
+        record_miss(redis_client, e.stage)
+        if e.message_posted:
+            # Текст уже в треде ассистента: не возвращаем его, а просим только новый run
+            requeue_or_escalate(tenant, user_id, dict(data, run_pending=True))
+        else:
+            requeue_or_escalate(tenant, user_id, data, text=combined_messages)
+    except HistoryUnavailable as e:
+        # Не пропуск срока: учитываем отдельно, чтобы не путать сбой базы истории с нагрузкой
+        logger.error(f"---{e}, чат {user_id} будет поставлен заново---")
+        redis_operation(lambda: redis_client.incr(HISTORY_UNAVAILABLE_KEY))
+        requeue_or_escalate(tenant, user_id, data, text=combined_messages)
     except Exception as e:
         logger.error(f"---Ошибка при обработке сообщений пользователя {user_id}: {e}---")
         print(f"Ошибка при обработке сообщений пользователя {user_id}: {e}")
+    finally:
+        release_tenant_slot(tenant, self.request.id)
+
+def queue_mode():
+    """Режим работы по состоянию очереди Celery"""
+    try:
+        return current_mode(queue_stats(redis_client))
+    except Exception as e:
+        logger.warning(f"Не удалось получить состояние очереди: {e}")
+        return MODE_NORMAL
+
+# Сколько раз заново ставим чат, не успевший получить ответ, прежде чем передать менеджеру
+MAX_REQUEUES = 1
+
+def requeue_or_escalate(tenant, user_id, data, task_id=None, text=None):
+    """Не теряет сообщения: ставит чат в очередь со свежим сроком или передает менеджеру
+
+    task_id - id задачи, еще владеющей чатом (до склейки); None - свой id уже снят
+    при склейке, а text - забранные сообщения, их нужно вернуть обратно.
+    Чат переходит к новой задаче атомарно и только если его не забрала более новая:
+    тогда ответит она, а здесь ничего не делаем. Возвращает True, если чат наш.
+    Заглушку клиенту отправляем только когда ответ действительно будет.
+    """
+    requeues = int(data.get('requeues', 0))
+    if requeues >= MAX_REQUEUES:
+        if not chat_state.claim_requeue(tenant, user_id, task_id, None, text):
+            return False
+        logger.warning(f"---Чат {user_id} так и не получил ответ, передаем менеджеру---")
+        message_to_manager(data, False)
+        return True
+    new_task_id = str(uuid.uuid4())
+    if not chat_state.claim_requeue(tenant, user_id, task_id, new_task_id, text):
+        logger.info(f"***Чат {user_id} уже обрабатывает более новая задача***")
+        return False
+    message = dict(data, requeues=requeues + 1)
+    schedule_chat(tenant, user_id, message, queue_mode(), task_id=new_task_id)
+    logger.info(f"***Чат {user_id} поставлен заново: {new_task_id}***")
+    send_holding_message(redis_client, tenant, user_id)
+    return True
 
-def gpt_input(data_from_bitrix):
+def schedule_chat(tenant, user_id, message, mode, task_id=None):
+    """Ставит задачу обработки чата. Срок ответа - единственный источник и для expires задачи
+
+    task_id - заранее назначенный id, уже записанный в состояние чата (claim_requeue)
+    """
+    countdown = MODE_SETTINGS[mode]['countdown']
+    deadline = Deadline.after(countdown + MESSAGE_DEADLINE)
+    message['deadline'] = deadline.at
+    
+    new_task = process_user_messages.apply_async(
+        args=[user_id, message],
+        countdown=countdown,
+        expires=datetime.fromtimestamp(deadline.at, tz=timezone.utc),
+        task_id=task_id,
+    )
+    mark_enqueued(redis_client, new_task.id, countdown)
+    
+    # Запоминаем новый task_id в состоянии чата
+    if task_id is None:
+        chat_state.set_task(tenant, user_id, new_task.id)
+    return new_task
+
+@task_revoked.connect
+def on_task_revoked(sender=None, request=None, terminated=False, expired=False, **kwargs):
+    """Задача истекла в очереди: не теряем сообщение молча, а ставим чат заново
+
+    Замененная задача (чат уже у новой) тоже может истечь: тогда только снимаем учет.
+    """
+    if request is None or getattr(sender, 'name', None) != process_user_messages.name:
+        return
+    try:
+        mark_dequeued(redis_client, request.id)
+        user_id, data = request.args[0], request.args[1]
+        if terminated:
+            # Процесс убит SIGTERM и не дошел до finally: освобождаем слот бота здесь
+            release_tenant_slot(resolve_tenant(data), request.id)
+        if not expired:
+            return
+        if requeue_or_escalate(resolve_tenant(data), user_id, data, task_id=request.id):
+            record_dropped(redis_client)
+            logger.warning(f"---Задача {request.id} пользователя {user_id} истекла в очереди---")
+    except Exception as e:
+        logger.error(f"---Ошибка при обработке истекшей задачи: {e}---")
+
+# Минимум времени, с которым еще имеет смысл запускать ассистента (сек)
+GPT_MIN_BUDGET = 5
+
+# Статусы run, при которых в тред нельзя добавить сообщение или запустить новый run
+ACTIVE_RUN_STATUSES = ('queued', 'in_progress', 'cancelling')
+# Сколько ждем, пока отмененный run освободит тред (сек)
+RUN_CANCEL_WAIT = 10
+
+def wait_for_cancel(thread_id, run, timeout=RUN_CANCEL_WAIT, poll_interval=1):
+    """Ждет, пока run выйдет из активных статусов, не дольше timeout"""
+    end = time.monotonic() + timeout
+    while run.status in ACTIVE_RUN_STATUSES and time.monotonic() < end:
+        time.sleep(poll_interval)
+        run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
+    if run.status in ACTIVE_RUN_STATUSES:
+        logger.warning(f"---Run {run.id} все еще {run.status} после отмены---")
+    return run
+
+def wait_for_run(thread_id, run, deadline, poll_interval=1):
+    """Ждет завершения run ассистента, отменяя его, если срок ответа истек
+
+    Сообщение клиента к этому моменту уже в треде: повторная задача его не добавляет,
+    а только запускает новый run, когда отмененный освободит тред.
+    """
+    while run.status in ACTIVE_RUN_STATUSES:
+        if deadline.expired():
+            try:
+                run = client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run.id)
+                wait_for_cancel(thread_id, run)
+            except Exception as e:
+                logger.error(f"---Не удалось отменить run {run.id}: {e}---")
+            raise DeadlineExceeded('gpt_run', message_posted=True)
+        time.sleep(min(poll_interval, max(0.1, deadline.remaining())))
+        run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
+    return run
+
+def gpt_input(data_from_bitrix, tenant=None, deadline=None):
     """Обрабатывает запрос через GPT"""
+    tenant = tenant or tenant_registry.default()
+    deadline = deadline or Deadline()
     user_message = data_from_bitrix["text"]
     print(f'User_message: {user_message}')
     user_id = data_from_bitrix["user_id"]
-    conversation_history = get_conversation_history(user_id)
+    conversation_history = get_conversation_history(user_id, tenant=tenant, deadline=deadline)
     logger.info(f"3**User_message: {user_message} --- and ---tthread {conversation_history} ***")
 
     if conversation_history is None:
@@ -203,23 +430,32 @@ def gpt_input(data_from_bitrix):
                 "role": "user",
                 "content": "Прайс или цена услуги товара описание или характиристика",
                 "attachments": [
-                    {"file_id": f"{os.environ.get('file_id')}", "tools": [{"type": "file_search"}]}
+                    {"file_id": f"{tenant.file_id}", "tools": [{"type": "file_search"}]}
                 ],
             }]
         )
         conversation_history = thread.id 
-        save_conversation_history(user_id, conversation_history)
+        save_conversation_history(user_id, conversation_history, tenant=tenant, deadline=deadline)
 
-    message = client.beta.threads.messages.create(
-        thread_id=conversation_history,
-        role="user",
-        content=f"{user_message}",
-    )
+    deadline.check('gpt_start', GPT_MIN_BUDGET)
+    if data_from_bitrix.get('run_pending'):
+        # Прошлая попытка отменила run: дожидаемся, пока тред освободится
+        runs = client.beta.threads.runs.list(thread_id=conversation_history, limit=1)
+        if runs.data and runs.data[0].status in ACTIVE_RUN_STATUSES:
+            wait_for_cancel(conversation_history, runs.data[0])
+    # Пустой текст - повтор после отмены run: сообщение клиента уже в треде
+    if user_message and not user_message.isspace():
+        message = client.beta.threads.messages.create(
+            thread_id=conversation_history,
+            role="user",
+            content=f"{user_message}",
+        )
 
-    run = client.beta.threads.runs.create_and_poll(
+    run = client.beta.threads.runs.create(
         thread_id=conversation_history,
-        assistant_id=assistant.id
+        assistant_id=tenant.assistant_id
     )
+    run = wait_for_run(conversation_history, run, deadline)
 
     if run.status == 'completed': 
         messages = client.beta.threads.messages.list(
@@ -235,37 +471,39 @@ def gpt_input(data_from_bitrix):
  
     return assistant_reply
 
-def webhook(first_message, gpt_answer='code_gpt_base'):
+def webhook(first_message, gpt_answer='code_gpt_base', tenant=None, deadline=None):
     """Отправляет сообщение через webhook"""
+    tenant = tenant or resolve_tenant(first_message)
+    deadline = deadline or Deadline.from_message(first_message)
     if gpt_answer == 'code_gpt_base':
+        deadline.check('gpt_input', GPT_MIN_BUDGET)
         gpt_data = {}
         gpt_data['text'] = first_message.get('text')
         gpt_data['user_id'] = first_message.get('chatId')
-        gpt_answer = gpt_input(gpt_data)
-
-    json_data = {
-        'channelId': first_message.get('channelId'),
-        'chatId': first_message.get('chatId'),
-        'chatType': 'whatsapp',
-        'text': f'{gpt_answer}',
-    }
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {os.environ.get("wazzap_api_key")}',
-    }
+        gpt_data['run_pending'] = first_message.get('run_pending', False)
+        gpt_answer = gpt_input(gpt_data, tenant=tenant, deadline=deadline)
+        # Ответ уже оплачен, поэтому отправляем его даже с опозданием, но учитываем пропуск
+        if deadline.expired():
+            record_miss(redis_client, 'send')
+
+    # Ответ кладется в outbox, доставкой в Wazzup занимается отдельный sender
     try:
-        response = requests.post("https://api.wazzup24.com/v3/message", headers=headers, json=json_data)
-        response_data = response.json()
+        response_data = redis_operation(
+            lambda: enqueue_message(redis_client, tenant, first_message.get('chatId'), gpt_answer)
+        )
     except Exception as e:
+        logger.error(f"---Не удалось записать ответ в outbox: {e}---")
         response_data = e
     return {"message": f"{gpt_answer}", "response_text": f"{response_data}"}
 
+# Используем абсолютный путь в /tmp, который доступен на Heroku
+SQLITE_DB_PATH = '/tmp/conversation.db'
+
 # Контекстный менеджер для безопасной работы с SQLite
 class SQLiteConnection:
     def __init__(self, db_name=None, max_retries=5, retry_delay=0.1):
         if db_name is None:
-            # Используем абсолютный путь в /tmp, который доступен на Heroku
-            self.db_name = '/tmp/conversation.db'
+            self.db_name = SQLITE_DB_PATH
         else:
             self.db_name = db_name
         self.conn = None
@@ -283,7 +521,8 @@ class SQLiteConnection:
             conn.execute('''
                 CREATE TABLE IF NOT EXISTS conversation_history (
                     user_id TEXT PRIMARY KEY,
-                    history TEXT
+                    history TEXT,
+                    status BOOLEAN DEFAULT TRUE
                 )
             ''')
             conn.commit()
@@ -327,11 +566,17 @@ def save_user_info(user_account, channel_id):
     except Exception as e:
         print(f"Ошибка при сохранении информации о пользователе: {e}")
 
-def check_status_conversation(user_id):
+def conversation_key(user_id, tenant=None):
+    """Ключ статуса разговора: chatId_бот, либо прежний chatId для бота с legacy_status_key"""
+    if tenant is None or tenant.legacy_status_key:
+        return f"{user_id}"
+    return f"{user_id}_{tenant.key}"
+
+def check_status_conversation(user_id, tenant=None):
     """Проверяет статус разговора пользователя"""
     try:
         with SQLiteConnection() as cursor:
-            cursor.execute('SELECT status FROM conversation_history WHERE user_id = ?', (user_id,))
+            cursor.execute('SELECT status FROM conversation_history WHERE user_id = ?', (conversation_key(user_id, tenant),))
             result = cursor.fetchone()
             
         if result is None:
@@ -341,15 +586,15 @@ def check_status_conversation(user_id):
         print(f"Ошибка при проверке статуса разговора: {e}")
         return True
 
-def update_status(user_id):
+def update_status(user_id, tenant=None):
     """Обновляет статус разговора пользователя"""
     try:
         with SQLiteConnection() as cursor:
+            # Строки для chatId_бот может еще не быть, поэтому вставляем или обновляем
             cursor.execute('''
-                UPDATE conversation_history
-                SET status = ?
-                WHERE user_id = ?
-            ''', (0, user_id))
+                INSERT INTO conversation_history (user_id, status) VALUES (?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET status = excluded.status
+            ''', (conversation_key(user_id, tenant), 0))
     except Exception as e:
         print(f"Ошибка при обновлении статуса разговора: {e}")
 
@@ -369,14 +614,14 @@ def extract_role_content(data, history=False):
     else:
         return results[0]['content']
 
-def with_lock(client_id, operation_func, *args, **kwargs):
+def with_lock(tenant, client_id, operation_func, *args, **kwargs):
     """Выполняет операцию с блокировкой"""
-    lock_key = f"lock:{client_id}"
+    owner = uuid.uuid4().hex
     lock_acquired = False
     
     try:
         # Пытаемся получить блокировку
-        lock_acquired = redis_client.set(lock_key, "locked", nx=True, ex=10)
+        lock_acquired = chat_state.acquire_lock(tenant, client_id, owner)
         
         if lock_acquired:
             # Если блокировка получена, выполняем функцию
@@ -385,7 +630,7 @@ def with_lock(client_id, operation_func, *args, **kwargs):
             # Если блокировка не получена, ждем и повторяем попытку
             for _ in range(5):  # Пробуем 5 раз
                 time.sleep(0.5)
-                lock_acquired = redis_client.set(lock_key, "locked", nx=True, ex=10)
+                lock_acquired = chat_state.acquire_lock(tenant, client_id, owner)
                 if lock_acquired:
                     return operation_func(*args, **kwargs)
             
@@ -395,40 +640,56 @@ def with_lock(client_id, operation_func, *args, **kwargs):
     finally:
         # Гарантированно освобождаем блокировку, если она была получена
         if lock_acquired:
-            redis_client.delete(lock_key)
+            chat_state.release_lock(tenant, client_id, owner)
+
+def public_url(tenant):
+    """Публичный адрес web-приложения, которое отдает /history (PUBLIC_URL)
+
+    bot_url - это идентификатор бота в Redis и базе истории; после объединения он
+    указывает на старое приложение бота. Без PUBLIC_URL (один бот на своем
+    приложении) оба адреса совпадают.
+    """
+    base = os.environ.get('PUBLIC_URL')
+    if base:
+        return base.rstrip('/') + '/'
+    return tenant.bot_url
 
 def message_to_manager(first_message, analyzer=True):
     """Отправляет сообщение менеджеру с блокировкой"""
     client_id = first_message.get('chatId')
+    tenant = resolve_tenant(first_message)
+    history_url = f'{public_url(tenant)}history?userid={client_id}&channel={tenant.channel_id}'
     
     def _process_message():
-        if check_status_conversation(client_id):
-            print(f"Status conversation history is -- {check_status_conversation(client_id)}")
-            webhook(first_message, gpt_answer=os.environ.get("trigger_words"))
-            update_status(client_id)
+        if check_status_conversation(client_id, tenant):
+            print(f"Status conversation history is -- {check_status_conversation(client_id, tenant)}")
+            webhook(first_message, gpt_answer=tenant.trigger_words, tenant=tenant)
+            update_status(client_id, tenant)
             
             # Отправляем сообщение менеджеру
             manager_message = first_message.copy()
-            manager_message['chatId'] = os.environ.get("admin_phone")
+            manager_message['chatId'] = tenant.admin_phone
             
             if analyzer:
-                message = f'Посмотри медиа файл, {first_message.get("contentUri")} \n а тут переписка - {os.getenv("bot_url")}history?userid={client_id} \n Кстати, а вот и номер клиента +{client_id}'
+                message = f'Посмотри медиа файл, {first_message.get("contentUri")} \n а тут переписка - {history_url} \n Кстати, а вот и номер клиента +{client_id}'
             else:
-                message = f'Посмотри переписку, бот не может ответить \n вот тут переписка - {os.getenv("bot_url")}history?userid={client_id} \n Кстати, вот и номер клиента +{client_id}'
+                message = f'Посмотри переписку, бот не может ответить \n вот тут переписка - {history_url} \n Кстати, вот и номер клиента +{client_id}'
                 
-            webhook(manager_message, gpt_answer=message)
+            webhook(manager_message, gpt_answer=message, tenant=tenant)
     
     # Выполняем с блокировкой
-    return with_lock(client_id, _process_message)
+    return with_lock(tenant, client_id, _process_message)
 
 @shared_task
 def cleanup_stale_locks():
-    """Очищает устаревшие блокировки"""
+    """Очищает устаревшие блокировки старой схемы (lock:*)
+
+    Блокировки в хэше состояния чата хранят срок внутри и перехватываются после него сами.
+    """
     try:
         lock_pattern = "lock:*"
-        keys = redis_client.keys(lock_pattern)
         
-        for key in keys:
+        for key in redis_client.scan_iter(match=lock_pattern, count=500):
             # Проверка TTL ключа
             ttl = redis_client.ttl(key)
             if ttl < 0:  # Если TTL истек или не установлен
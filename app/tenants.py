@@ -0,0 +1,178 @@
+import os
+import re
+import hashlib
+import json
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Ключ Redis, в котором хранится реестр ботов (JSON-список), чтобы его можно было
+# обновить на всех dyno сразу без передеплоя
+TENANTS_REDIS_KEY = "tenants:registry"
+
+# Лимит задач на бота, если их в реестре несколько, а max_concurrency не задан
+DEFAULT_TENANT_CONCURRENCY = 2
+
+
+def clean_url(url: str) -> str:
+    return re.sub(r'https://|\.herokuapp\.com/', '', url)
+
+
+class Tenant:
+    """Настройки одного бота (клиента), обслуживаемого общим web/worker"""
+
+    def __init__(self, channel_id, bot_url, assistant_id, file_id, wazzup_api_key,
+                 trigger_words=None, admin_phone=None, max_concurrency=None, holding_message=None,
+                 tag=None, legacy_status_key=False):
+        self.channel_id = channel_id
+        self.bot_url = bot_url
+        self.assistant_id = assistant_id
+        self.file_id = file_id
+        self.wazzup_api_key = wazzup_api_key
+        self.trigger_words = trigger_words
+        self.admin_phone = admin_phone
+        # None - лимит не задан явно (см. TenantRegistry.concurrency_limit)
+        self.max_concurrency = int(max_concurrency) if max_concurrency is not None else None
+        self.holding_message = holding_message
+        # Статус разговора хранится под голым chatId (как до объединения ботов)
+        self.legacy_status_key = bool(legacy_status_key)
+        # Префикс ключей Redis и идентификатор бота в базе истории
+        self.key = clean_url(bot_url or '')
+        # Короткий префикс для ключей состояния чатов; уникальность проверяет реестр
+        self.tag = tag or hashlib.sha1(self.key.encode()).hexdigest()[:10]
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            channel_id=data['channel_id'],
+            bot_url=data['bot_url'],
+            assistant_id=data['assistant_id'],
+            file_id=data.get('file_id'),
+            wazzup_api_key=data['wazzup_api_key'],
+            trigger_words=data.get('trigger_words'),
+            admin_phone=data.get('admin_phone'),
+            max_concurrency=data.get('max_concurrency'),
+            holding_message=data.get('holding_message'),
+            tag=data.get('tag'),
+            legacy_status_key=data.get('legacy_status_key', False),
+        )
+
+    @classmethod
+    def from_env(cls):
+        """Бот из старых переменных окружения (режим одного бота)"""
+        return cls(
+            channel_id=os.environ.get('channal_id'),
+            bot_url=os.environ.get('bot_url'),
+            assistant_id=os.environ.get('ASSISTANT_KEY'),
+            file_id=os.environ.get('file_id'),
+            wazzup_api_key=os.environ.get('wazzap_api_key'),
+            trigger_words=os.environ.get('trigger_words'),
+            admin_phone=os.environ.get('admin_phone'),
+            max_concurrency=os.environ.get('TENANT_MAX_CONCURRENCY'),
+            holding_message=os.environ.get('holding_message'),
+            legacy_status_key=True,
+        )
+
+    def __repr__(self):
+        return f"Tenant(channel_id={self.channel_id!r}, key={self.key!r})"
+
+
+class TenantRegistry:
+    """Реестр ботов: channelId -> Tenant, с кэшем и горячей перезагрузкой
+
+    Источники в порядке приоритета: ключ Redis `tenants:registry`,
+    переменная окружения TENANTS (JSON-список), старые переменные одного бота.
+    """
+
+    def __init__(self, redis_client=None, reload_interval=30):
+        self.redis_client = redis_client
+        self.reload_interval = reload_interval
+        self._tenants = {}
+        self._raw = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    def _read_source(self):
+        if self.redis_client is not None:
+            try:
+                raw = self.redis_client.get(TENANTS_REDIS_KEY)
+                if raw:
+                    return raw
+            except Exception as e:
+                logger.warning(f"Не удалось прочитать реестр ботов из Redis: {e}")
+        return os.environ.get('TENANTS')
+
+    def _load(self):
+        raw = self._read_source()
+        if raw is not None and raw == self._raw:
+            return
+        tenants = {}
+        if raw:
+            try:
+                tags = set()
+                for item in json.loads(raw):
+                    tenant = Tenant.from_dict(item)
+                    # Совпавший префикс смешал бы состояние чатов двух ботов
+                    if tenant.tag in tags:
+                        raise ValueError(f"повторяющийся tag {tenant.tag!r} у {tenant.channel_id}")
+                    tags.add(tenant.tag)
+                    tenants[tenant.channel_id] = tenant
+            except (ValueError, KeyError, TypeError) as e:
+                logger.error(f"Ошибка в реестре ботов, оставляем прежний: {e}")
+                if self._tenants:
+                    return
+                tenants = {}
+        if not tenants:
+            tenant = Tenant.from_env()
+            if tenant.channel_id:
+                tenants[tenant.channel_id] = tenant
+        self._tenants = tenants
+        self._raw = raw
+        logger.info(f"Загружен реестр ботов: {list(tenants)}")
+
+    def _ensure_fresh(self):
+        if time.monotonic() - self._loaded_at < self.reload_interval and self._tenants:
+            return
+        with self._lock:
+            if time.monotonic() - self._loaded_at < self.reload_interval and self._tenants:
+                return
+            self._load()
+            self._loaded_at = time.monotonic()
+
+    def reload(self):
+        """Принудительно перечитывает реестр"""
+        with self._lock:
+            self._raw = None
+            self._load()
+            self._loaded_at = time.monotonic()
+
+    def get(self, channel_id):
+        """Возвращает Tenant по channelId или None, если бот не зарегистрирован"""
+        self._ensure_fresh()
+        return self._tenants.get(channel_id)
+
+    def all(self):
+        self._ensure_fresh()
+        return list(self._tenants.values())
+
+    def concurrency_limit(self, tenant):
+        """Сколько задач бота может выполняться одновременно; None - без ограничения
+
+        Единственный бот без явного лимита использует весь пул воркеров, как до
+        объединения; при нескольких ботах лимит по умолчанию DEFAULT_TENANT_CONCURRENCY.
+        """
+        if tenant.max_concurrency is not None:
+            return tenant.max_concurrency
+        if len(self.all()) > 1:
+            return DEFAULT_TENANT_CONCURRENCY
+        return None
+
+    def default(self):
+        """Единственный бот в режиме одного бота (для старых вызовов без channelId)"""
+        self._ensure_fresh()
+        tenant = self._tenants.get(os.environ.get('channal_id'))
+        if tenant is None and len(self._tenants) == 1:
+            tenant = next(iter(self._tenants.values()))
+        return tenant
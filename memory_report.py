@@ -0,0 +1,10 @@
+import sys
+import json
+from app.tasks import redis_client, tenant_registry
+from app.chat_state import memory_report
+
+# Использование: python memory_report.py [число чатов]
+if __name__ == '__main__':
+    chats = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    tenant = tenant_registry.default() or tenant_registry.all()[0]
+    print(json.dumps(memory_report(redis_client, tenant, chats), indent=2))
@@ -0,0 +1,24 @@
+import os
+import sys
+import logging
+from app.tasks import redis_client, tenant_registry
+from app.outbox import OutboxSender, redrive_dead
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+)
+
+if __name__ == '__main__':
+    # python sender.py redrive [N] - вернуть сообщения из outbox:dead в отправку
+    if len(sys.argv) > 1 and sys.argv[1] == 'redrive':
+        count = int(sys.argv[2]) if len(sys.argv) > 2 else None
+        print(f"Возвращено в outbox: {redrive_dead(redis_client, count)}")
+        sys.exit(0)
+
+    OutboxSender(
+        redis_client,
+        tenant_registry,
+        workers=int(os.environ.get('SENDER_WORKERS', 4)),
+        consumer_name=os.environ.get('DYNO'),
+    ).run()